@@ -1,36 +1,98 @@
 import os
-import json
 import io
+import itertools
+import time
+import random
+import threading
+import asyncio
+import multiprocessing
+import aiohttp
+import ijson
+import orjson
 from google.auth.transport.requests import Request
 from google.oauth2.credentials import Credentials
 from google_auth_oauthlib.flow import InstalledAppFlow
 from googleapiclient.discovery import build
-from googleapiclient.http import MediaIoBaseDownload
 from googleapiclient.errors import HttpError
-from typing import List, Dict, Any, Optional
+from concurrent.futures import ProcessPoolExecutor
+from datetime import timezone
+from typing import List, Dict, Any, Optional, Tuple
 
 # --- Configuration ---
 SCOPES = ["https://www.googleapis.com/auth/drive.readonly"]
 CREDENTIALS_FILE = "credentials.json"
 TOKEN_FILE = "token.json"
 OUTPUT_FILE = "chat_data.json"
+# Parse results per Drive file, reused while the file's modifiedTime is unchanged.
+CACHE_FILE = "chat_cache.json"
 # This is a literal folder name and should not be changed unless your folder is named differently.
 AI_STUDIO_FOLDER_NAME = "Google AI Studio"
+# Files of these types are never AI Studio chats and are excluded from the listing.
+KNOWN_NON_CHAT_MIME_TYPES = frozenset({
+    'application/javascript',
+    'text/css',
+    'text/plain',
+    'image/png',
+    'image/jpeg',
+    'application/json',
+    'application/vnd.google-apps.folder'
+})
+DRIVE_MEDIA_URL = "https://www.googleapis.com/drive/v3/files/{file_id}?alt=media"
+# Maximum number of file downloads in flight at the same time.
+DOWNLOAD_CONCURRENCY = 24
+# Google APIs only compress responses when the User-Agent also contains "gzip".
+DOWNLOAD_HEADERS = {
+    "Accept-Encoding": "gzip",
+    "User-Agent": "aistudio-chat-visualizer (gzip)"
+}
+
+# Rate-limited (429) and transient server errors are retried with exponential backoff.
+DRIVE_NUM_RETRIES = 7
+RETRYABLE_STATUSES = frozenset({429, 500, 502, 503, 504})
+# Drive reports most throttling as 403 with one of these reasons rather than 429.
+RATE_LIMIT_REASONS = frozenset({"userRateLimitExceeded", "rateLimitExceeded"})
+MAX_RETRY_DELAY = 60
+
+# Refresh cached credentials this many seconds before Google's expiry time.
+CREDS_REFRESH_MARGIN = 300
+# Fallback lifetime (55 minutes) for credentials that carry no expiry.
+CREDS_CACHE_TTL = 55 * 60
+
+# In-process cache so repeated authenticate() calls skip re-reading token.json.
+_CREDS_CACHE: Dict[str, Any] = {"creds": None, "expiry": 0.0}
+
+# Generated JSON is compact; set PRETTY_JSON=1 to indent it for manual inspection.
+JSON_DUMP_OPTION = orjson.OPT_INDENT_2 if os.environ.get("PRETTY_JSON") == "1" else 0
 
 # --- Core Functions ---
 
+def _cache_credentials(creds: Credentials):
+    """Stores credentials in the in-process cache until shortly before they expire."""
+    if creds.expiry:
+        # google-auth keeps expiry as a naive UTC datetime.
+        expiry = creds.expiry.replace(tzinfo=timezone.utc).timestamp() - CREDS_REFRESH_MARGIN
+    else:
+        expiry = time.time() + CREDS_CACHE_TTL
+    _CREDS_CACHE["creds"] = creds
+    _CREDS_CACHE["expiry"] = expiry
+
 def authenticate() -> Optional[Credentials]:
     """
     Handles user authentication via OAuth2.
     Creates or refreshes the token.json file.
-    Returns the credentials object.
+    Returns the credentials object, cached in-process until shortly before it expires.
     """
-    creds = None
-    if os.path.exists(TOKEN_FILE):
+    creds = _CREDS_CACHE["creds"]
+    if creds and time.time() < _CREDS_CACHE["expiry"]:
+        return creds
+
+    # A cached object past its safety margin is refreshed proactively below.
+    expiring = creds is not None
+    if not creds and os.path.exists(TOKEN_FILE):
         creds = Credentials.from_authorized_user_file(TOKEN_FILE, SCOPES)
     
-    if not creds or not creds.valid:
-        if creds and creds.expired and creds.refresh_token:
+    if not creds or not creds.valid or expiring:
+        if creds and (creds.expired or expiring) and creds.refresh_token:
             try:
                 creds.refresh(Request())
             except Exception as e:
@@ -43,12 +105,13 @@ def authenticate() -> Optional[Credentials]:
         
         with open(TOKEN_FILE, "w") as token:
             token.write(creds.to_json())
+    _cache_credentials(creds)
     return creds
 
 def find_aistudio_folder_id(service: Any) -> Optional[str]:
     """Finds and returns the ID of the Google AI Studio folder."""
     query = f"mimeType='application/vnd.google-apps.folder' and name='{AI_STUDIO_FOLDER_NAME}' and trashed=false"
-    response = service.files().list(q=query, spaces="drive", fields="files(id)").execute()
+    response = service.files().list(q=query, spaces="drive", fields="files(id)").execute(num_retries=DRIVE_NUM_RETRIES)
     if not response['files']:
         return None
     return response['files'][0]['id']
@@ -57,15 +120,18 @@ def fetch_all_files(service: Any, folder_id: str) -> List[Dict[str, Any]]:
     """Retrieves a list of all files from the specified folder, handling pagination."""
     files = []
     page_token = None
-    query = f"'{folder_id}' in parents and trashed=false"
+    # Filter known non-chat types server-side so they are never listed at all.
+    mime_filter = "".join(f" and mimeType != '{mime_type}'" for mime_type in sorted(KNOWN_NON_CHAT_MIME_TYPES))
+    query = f"'{folder_id}' in parents and trashed=false{mime_filter}"
     
     print("--- Fetching file list from Google Drive... ---")
     while True:
         response = service.files().list(
             q=query, spaces='drive', pageSize=1000, 
+            # Every field here ends up in chat_data.json or the mimeType guard; keep the list minimal.
             fields="nextPageToken, files(id, name, description, createdTime, modifiedTime, mimeType)",
             pageToken=page_token
-        ).execute()
+        ).execute(num_retries=DRIVE_NUM_RETRIES)
         files.extend(response.get('files', []))
         page_token = response.get('nextPageToken', None)
         if page_token is None:
@@ -73,85 +139,279 @@ def fetch_all_files(service: Any, folder_id: str) -> List[Dict[str, Any]]:
     print(f"--- Found {len(files)} total files. ---")
     return files
 
-def process_files(service: Any, files: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+def retry_delay(attempt: int, retry_after: Optional[str] = None) -> float:
     """
-    Processes a list of files: downloads content, parses JSON, and builds the initial chat map.
+    Returns how long to wait before retrying a failed Drive request.
+    Honors a numeric Retry-After header, otherwise uses exponential backoff with jitter.
     """
-    chat_map = []
-    total_files = len(files)
-    for i, file_data in enumerate(files):
-        file_name = file_data.get("name", "Unknown")
-        # \r carriage return and end="" creates a single-line progress indicator.
-        print(f"\r--- Processing file {i+1}/{total_files}: {file_name[:50]:<50}", end="")
+    if retry_after:
+        try:
+            return float(retry_after)
+        except ValueError:
+            pass # HTTP-date form; fall back to backoff
+    return min(2 ** attempt, MAX_RETRY_DELAY) + random.random()
 
-        mime_type = file_data.get("mimeType", "")
+async def is_retryable_response(resp: aiohttp.ClientResponse) -> bool:
+    """Checks whether a Drive response is a transient error or a rate limit worth retrying."""
+    if resp.status in RETRYABLE_STATUSES:
+        return True
+    if resp.status != 403:
+        return False
+    try:
+        error = orjson.loads(await resp.read()).get("error", {})
+        reasons = {detail.get("reason") for detail in error.get("errors", [])}
+    except (orjson.JSONDecodeError, AttributeError):
+        return False
+    return not reasons.isdisjoint(RATE_LIMIT_REASONS)
+
+def normalize_prompt_id(branch: Dict[str, Any]) -> str:
+    """Returns a branch's promptId without the 'prompts/' prefix, or "" if it is missing or null."""
+    return (branch.get("promptId") or "").replace("prompts/", "")
 
-        known_non_chat_types = [
-            'application/javascript', 
-            'text/css', 
-            'text/plain',
-            'image/png', 
-            'image/jpeg',
-            'application/json'
-        ]
-        if mime_type in known_non_chat_types:
+def parse_chat_bytes(pair: Tuple[Dict[str, Any], bytes]) -> Optional[Dict[str, Any]]:
+    """
+    Parses a downloaded chat file and builds its chat map entry.
+    Returns None if the content is not a valid JSON object.
+    Runs in a worker process, so it is kept at module level and takes a single picklable argument.
+    """
+    file_data, file_content = pair
+    try:
+        # Stream the chunks one at a time instead of materializing the whole document;
+        # ijson picks its fastest available backend (yajl2_c) on import.
+        events = ijson.parse(io.BytesIO(file_content))
+        first_event = next(events, None)
+        # Chats are JSON objects; arrays, scalars and empty files are not chats.
+        if first_event is None or first_event[1] != "start_map":
+            return None
+        chunks = ijson.items(itertools.chain([first_event], events), "chunkedPrompt.chunks.item")
+
+        parent_info = None
+        children_info = []
+        found_parent = False
+        found_children = False
+        # IDs are normalized here, once, so later link checks are plain dict lookups.
+        for chunk in chunks:
+            get = chunk.get
+            if not found_parent:
+                branch_parent = get("branchParent")
+                if branch_parent:
+                    parent_id = normalize_prompt_id(branch_parent)
+                    if parent_id:
+                        parent_info = {"id": parent_id}
+                    found_parent = True
+            if not found_children:
+                branch_children = get("branchChildren")
+                if branch_children:
+                    child_ids = (normalize_prompt_id(child) for child in branch_children)
+                    children_info = [{"id": child_id} for child_id in child_ids if child_id]
+                    found_children = True
+            # A chat carries at most one of each, so later chunks needn't be built into objects.
+            if found_parent and found_children:
+                break
+        # Still run the rest of the document through the parser, without materializing it,
+        # so truncated or corrupt files are rejected just like a full parse would.
+        for _ in events:
+            pass
+    except (ijson.JSONError, UnicodeDecodeError):
+        # Silently skip files that are not text or valid JSON.
+        return None
+
+    return build_chat_entry(file_data, parent_info, children_info)
+
+def build_chat_entry(file_data: Dict[str, Any], parent_info: Optional[Dict[str, str]],
+                     children_info: List[Dict[str, str]]) -> Dict[str, Any]:
+    """Combines a file's Drive metadata with its branch links into a chat map entry."""
+    return {
+        "fileName": file_data.get("name", "Unknown"),
+        "fileId": file_data.get("id").replace("prompts/", ""),
+        "parent": parent_info,
+        "children": children_info,
+        "createdDate": file_data.get("createdTime"),
+        "modifiedDate": file_data.get("modifiedTime"),
+        "description": file_data.get("description")
+    }
+
+def load_file_cache(filename: str) -> Dict[str, Any]:
+    """Loads the per-file parse cache. Returns an empty cache if the file is missing or invalid."""
+    try:
+        with open(filename, "rb") as f:
+            cache = orjson.loads(f.read())
+    except (FileNotFoundError, orjson.JSONDecodeError):
+        return {}
+    return cache if isinstance(cache, dict) else {}
+
+def save_file_cache(filename: str, cache: Dict[str, Any]):
+    """
+    Saves the per-file parse cache.
+    Written to a temporary file and moved into place, so an interrupted run keeps the old cache.
+    """
+    tmp_path = f"{filename}.tmp.{os.getpid()}.{threading.get_ident()}"
+    try:
+        with open(tmp_path, "wb") as f:
+            f.write(orjson.dumps(cache, option=JSON_DUMP_OPTION))
+        os.replace(tmp_path, filename)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+def _is_link(link: Any) -> bool:
+    return isinstance(link, dict) and isinstance(link.get("id"), str)
+
+def read_cache_entry(entry: Any, modified_time: Optional[str]) -> Tuple[bool, Optional[Dict[str, Any]]]:
+    """
+    Returns (hit, links) for a file's cache entry; links is None for files that are not chats.
+    Outdated or structurally invalid entries count as a miss, so the file is downloaded again.
+    """
+    if not modified_time or not isinstance(entry, dict) or entry.get("modifiedTime") != modified_time:
+        return False, None
+    if "links" not in entry:
+        return False, None
+    links = entry["links"]
+    if links is None:
+        return True, None
+    if not isinstance(links, dict) or "parent" not in links:
+        return False, None
+    parent, children = links["parent"], links.get("children")
+    if parent is not None and not _is_link(parent):
+        return False, None
+    if not isinstance(children, list) or not all(_is_link(child) for child in children):
+        return False, None
+    return True, links
+
+def process_files(creds: Credentials, files: List[Dict[str, Any]]) -> Tuple[List[Dict[str, Any]], Dict[str, Dict[str, Any]]]:
+    """
+    Processes a list of files: downloads content concurrently, parses JSON, and builds the initial chat map.
+    Files whose modifiedTime matches the cache are not downloaded again.
+    Returns the chat map together with the same entries indexed by fileId.
+    """
+    # fetch_all_files already excludes these types server-side; this guards any other
+    # caller so discarded files never get a request scheduled for them.
+    # Drive's /batch endpoint does not support media downloads, so round trips are
+    # kept cheap by the shared session instead of multipart batching.
+    candidates = []
+    for file_data in files:
+        mime_type = file_data.get("mimeType", "")
+        if mime_type in KNOWN_NON_CHAT_MIME_TYPES or mime_type.startswith('image/'):
             continue
+        candidates.append(file_data)
+    print(f"--- Skipping {len(files) - len(candidates)} non-chat files. ---")
+
+    # Cache entries are {"modifiedTime": ..., "links": {"parent": ..., "children": ...}},
+    # with "links" set to None for files that turned out not to be chats.
+    file_cache = load_file_cache(CACHE_FILE)
+    new_cache = {}
+    results: List[Optional[Dict[str, Any]]] = [None] * len(candidates)
+    pending = []
+    for index, file_data in enumerate(candidates):
+        cached = file_cache.get(file_data.get("id"))
+        hit, links = read_cache_entry(cached, file_data.get("modifiedTime"))
+        if hit:
+            if links is not None:
+                results[index] = build_chat_entry(file_data, links["parent"], links["children"])
+            new_cache[file_data["id"]] = cached
+        else:
+            pending.append((index, file_data))
+    print(f"--- Reusing {len(candidates) - len(pending)} unchanged files from cache. ---")
+
+    total_files = len(pending)
+    processed_count = 0
+
+    async def fetch_one(pool: ProcessPoolExecutor, session: aiohttp.ClientSession,
+                        file_data: Dict[str, Any]) -> Tuple[bool, Optional[Dict[str, Any]]]:
+        """Returns (fetched, chat); fetched is False if the download or processing failed."""
+        nonlocal processed_count
+        file_name = file_data.get("name", "Unknown")
+        processed_count += 1
+        # \r carriage return and end="" creates a single-line progress indicator.
+        print(f"\r--- Processing file {processed_count}/{total_files}: {file_name[:50]:<50}", end="")
 
         try:
-            request = service.files().get_media(fileId=file_data.get("id"))
-            fh = io.BytesIO()
-            downloader = MediaIoBaseDownload(fh, request)
-            done = False
-            while not done:
-                _, done = downloader.next_chunk()
-            
-            file_content = fh.getvalue().decode('utf-8')
-            data = json.loads(file_content)
-            
-            parent_info = None
-            children_info = []
-            chunks = data.get("chunkedPrompt", {}).get("chunks", [])
-            for chunk in chunks:
-                if chunk.get("branchParent"):
-                    parent_info = {"id": chunk["branchParent"].get("promptId")}
-                if chunk.get("branchChildren"):
-                    children_info = [{"id": child.get("promptId")} for child in chunk["branchChildren"]]
-
-            chat_map.append({
-                "fileName": file_name,
-                "fileId": file_data.get("id").replace("prompts/", ""),
-                "parent": parent_info,
-                "children": children_info,
-                "createdDate": file_data.get("createdTime"),
-                "modifiedDate": file_data.get("modifiedTime"),
-                "description": file_data.get("description")
-            })
-            
-        except (json.JSONDecodeError, UnicodeDecodeError):
-            # Silently skip files that are not text or valid JSON.
-            continue
+            url = DRIVE_MEDIA_URL.format(file_id=file_data.get("id"))
+            for attempt in range(DRIVE_NUM_RETRIES + 1):
+                last_attempt = attempt == DRIVE_NUM_RETRIES
+                try:
+                    async with session.get(url, headers={"Authorization": f"Bearer {creds.token}"}) as resp:
+                        if not last_attempt and await is_retryable_response(resp):
+                            delay = retry_delay(attempt, resp.headers.get("Retry-After"))
+                        else:
+                            resp.raise_for_status()
+                            file_content = await resp.read()
+                            break
+                except (aiohttp.ClientConnectionError, asyncio.TimeoutError):
+                    # Dropped connections and timeouts are transient, like socket errors in execute().
+                    if last_attempt:
+                        raise
+                    delay = retry_delay(attempt)
+                # Sleep outside the response context so the connection goes back to the pool.
+                await asyncio.sleep(delay)
+
+            # Parsing is CPU-bound, so it runs in worker processes while other downloads continue.
+            loop = asyncio.get_running_loop()
+            return True, await loop.run_in_executor(pool, parse_chat_bytes, (file_data, file_content))
         except Exception as e:
             print(f"\n--- An unexpected error occurred while processing file {file_name}: {e}")
-    
+            return False, None
+
+    async def guarded(semaphore: asyncio.Semaphore, pool: ProcessPoolExecutor,
+                      session: aiohttp.ClientSession, file_data: Dict[str, Any]):
+        async with semaphore:
+            return await fetch_one(pool, session, file_data)
+
+    async def run() -> List[Tuple[bool, Optional[Dict[str, Any]]]]:
+        semaphore = asyncio.Semaphore(DOWNLOAD_CONCURRENCY)
+        # One pooled connector keeps TLS connections to Drive alive across all downloads.
+        connector = aiohttp.TCPConnector(
+            limit=DOWNLOAD_CONCURRENCY, limit_per_host=DOWNLOAD_CONCURRENCY, keepalive_timeout=60
+        )
+        # refresh-data runs this from a server thread, and forking a multi-threaded process
+        # is unsafe, so workers are started fresh (forkserver where available, else spawn).
+        start_method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+        max_workers = min(len(pending), os.cpu_count() or 1)
+        with ProcessPoolExecutor(max_workers=max_workers, mp_context=multiprocessing.get_context(start_method)) as pool:
+            # aiohttp transparently decompresses the gzip-encoded bodies.
+            async with aiohttp.ClientSession(connector=connector, headers=DOWNLOAD_HEADERS) as session:
+                return await asyncio.gather(*(guarded(semaphore, pool, session, f) for _, f in pending))
+
+    if pending:
+        # Downloads bypass the API client, so make sure the bearer token is fresh before starting.
+        creds.refresh(Request())
+        # gather() preserves input order, so results line up with `pending`.
+        for (index, file_data), (fetched, chat) in zip(pending, asyncio.run(run())):
+            if not fetched:
+                # Left out of the cache so the file is retried on the next run.
+                continue
+            results[index] = chat
+            links = {"parent": chat["parent"], "children": chat["children"]} if chat else None
+            new_cache[file_data["id"]] = {"modifiedTime": file_data.get("modifiedTime"), "links": links}
+    # Saved before sanitize_chat_links adjusts parents, so the cache holds links as parsed.
+    # Rebuilt from the current listing, so files removed from Drive drop out of it.
+    save_file_cache(CACHE_FILE, new_cache)
+
+    # Results are indexed by candidate, so the chat map keeps the Drive listing order.
+    chat_map = []
+    chat_map_by_id = {}
+    for chat in results:
+        if chat is not None:
+            chat_map.append(chat)
+            chat_map_by_id[chat['fileId']] = chat
+
     print("\n--- File processing complete. ---")
-    return chat_map
+    return chat_map, chat_map_by_id
 
-def sanitize_chat_links(chat_map: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+def sanitize_chat_links(chat_map: List[Dict[str, Any]], chat_map_by_id: Dict[str, Dict[str, Any]]) -> List[Dict[str, Any]]:
     """
     Fixes 'broken' parent links by iterating through the chat map once.
     """
     print("\n--- Checking link integrity... ---")
-    chat_map_by_id = {chat['fileId']: chat for chat in chat_map}
     fixed_links_count = 0
 
     for parent_chat in chat_map:
         if parent_chat['children']:
             for child_info in parent_chat['children']:
-                child_id = child_info['id'].replace('prompts/', '')
-                if child_id in chat_map_by_id:
-                    child_chat_object = chat_map_by_id[child_id]
+                child_chat_object = chat_map_by_id.get(child_info['id'])
+                if child_chat_object:
                     if child_chat_object['parent'] is None:
-                        child_chat_object['parent'] = {'id': f"prompts/{parent_chat['fileId']}"}
+                        child_chat_object['parent'] = {'id': parent_chat['fileId']}
                         print(f"\n--- Checking link integrity: '{parent_chat['fileName']}' -> '{child_chat_object['fileName']}'")
                         fixed_links_count += 1
     
@@ -161,8 +421,8 @@ def sanitize_chat_links(chat_map: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
 def save_data(folder_id: str, chat_map: List[Dict[str, Any]], filename: str):
     """Saves the final data structure to a JSON file."""
     output_data = {"folderId": folder_id, "chats": chat_map}
-    with open(filename, "w", encoding="utf-8") as f:
-        json.dump(output_data, f, indent=2, ensure_ascii=False)
+    with open(filename, "wb") as f:
+        f.write(orjson.dumps(output_data, option=JSON_DUMP_OPTION | orjson.OPT_NON_STR_KEYS))
     print(f"\n\n--- SUCCESS! ---\nChat map ({len(chat_map)} chats) saved to file: {filename}")
 
 # --- Main Execution ---
@@ -184,8 +444,8 @@ def main():
         print(f"--- Folder '{AI_STUDIO_FOLDER_NAME}' found. ---")
 
         all_files = fetch_all_files(service, folder_id)
-        raw_chat_map = process_files(service, all_files)
-        sanitized_chat_map = sanitize_chat_links(raw_chat_map)
+        raw_chat_map, chat_map_by_id = process_files(creds, all_files)
+        sanitized_chat_map = sanitize_chat_links(raw_chat_map, chat_map_by_id)
         save_data(folder_id, sanitized_chat_map, OUTPUT_FILE)
 
     except HttpError as error:
@@ -1,43 +1,94 @@
-import json
 import os
+import threading
 import traceback
+import orjson
 import read_chats
 from flask import Flask, request, jsonify, send_from_directory
+from waitress import serve
 
 # --- Configuration ---
 app = Flask(__name__)
+# Worker threads for the waitress production server; requests are handled concurrently,
+# so the file helpers below must tolerate parallel reads and writes.
+SERVER_THREADS = 8
+# Parsed file contents keyed by path, stored as (st_mtime_ns, data).
+_JSON_CACHE = {}
 DATA_FILES = {
-    'favorites': {'path': 'favorites.json', 'default': []},
-    'tags': {'path': 'tags.json', 'default': {}},
-    'all_tags': {'path': 'all_tags.json', 'default': []}
+    'favorites': {'path': 'favorites.json', 'default': [], 'label': 'favorites'},
+    'tags': {'path': 'tags.json', 'default': {}, 'label': 'tags'},
+    'all_tags': {'path': 'all_tags.json', 'default': [], 'label': 'all tags'}
 }
+# One lock per data file, so the file on disk and its _JSON_CACHE entry change together.
+_FILE_LOCKS = {config['path']: threading.Lock() for config in DATA_FILES.values()}
 
 # --- Helper Functions ---
 
 def read_json_file(filepath, default_value):
     """
-    Safely reads a JSON file.
+    Safely reads a JSON file, reusing the parsed data while the file's mtime is unchanged.
     Returns the default value if the file is not found, is empty, or contains an error.
     """
     try:
-        if not os.path.exists(filepath):
-            return default_value
-        with open(filepath, 'r', encoding='utf-8') as f:
-            return json.load(f)
-    except (json.JSONDecodeError, FileNotFoundError):
+        # Held while stat-ing and reading, so a concurrent write can't pair this read's data
+        # with the mtime of the file it just replaced.
+        with _FILE_LOCKS[filepath]:
+            mtime_ns = os.stat(filepath).st_mtime_ns
+            cached = _JSON_CACHE.get(filepath)
+            if cached and cached[0] == mtime_ns:
+                return cached[1]
+            with open(filepath, 'rb') as f:
+                data = orjson.loads(f.read())
+            _JSON_CACHE[filepath] = (mtime_ns, data)
+            return data
+    except (orjson.JSONDecodeError, FileNotFoundError):
         return default_value
 
+def is_unchanged_on_disk(filepath, payload):
+    """
+    Checks whether the file still holds the cached data and that data serializes to `payload`.
+    Bytes are compared rather than objects, since e.g. True == 1 in Python but not in JSON.
+    Must be called with the file's lock held; the cache is only trusted under that lock.
+    """
+    cached = _JSON_CACHE.get(filepath)
+    if not cached:
+        return False
+    try:
+        if os.stat(filepath).st_mtime_ns != cached[0]:
+            return False
+    except FileNotFoundError:
+        return False
+    return orjson.dumps(cached[1], option=read_chats.JSON_DUMP_OPTION) == payload
+
 def write_json_file(filepath, data):
     """
     Safely writes data to a JSON file.
+    The data goes to a temporary file, is fsync'ed and then moved into place with os.replace,
+    so a crash or power loss mid-write leaves either the old or the new contents.
     Returns True on success, False on error.
     """
+    # Unique per process and thread, as waitress may handle two POSTs at once.
+    tmp_path = f"{filepath}.tmp.{os.getpid()}.{threading.get_ident()}"
     try:
-        with open(filepath, 'w', encoding='utf-8') as f:
-            json.dump(data, f, indent=2)
+        payload = orjson.dumps(data, option=read_chats.JSON_DUMP_OPTION)
+        # Mtimes are too coarse to tell two close writes apart, so the unchanged check, the
+        # replace and the cache update all happen under one lock to keep cache and disk in step.
+        with _FILE_LOCKS[filepath]:
+            if is_unchanged_on_disk(filepath, payload):
+                # The file on disk already holds exactly this data; skip the write entirely.
+                return True
+            with open(tmp_path, 'wb') as f:
+                f.write(payload)
+                # Make the bytes durable before the rename, so a power loss can't leave an empty file.
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, filepath)
+            # Prime the cache so the next GET doesn't re-parse what was just written.
+            _JSON_CACHE[filepath] = (os.stat(filepath).st_mtime_ns, data)
         return True
     except Exception as e:
         print(f"Error writing to file {filepath}: {e}")
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
         return False
 
 # --- Frontend Serving ---
@@ -54,41 +105,26 @@ def serve_static_files(path):
 
 # --- API Endpoints ---
 
-@app.route('/api/favorites', methods=['GET', 'POST'])
-def handle_favorites():
-    """Handles reading and writing the favorites data."""
-    config = DATA_FILES['favorites']
-    if request.method == 'GET':
-        data = read_json_file(config['path'], config['default'])
-        return jsonify(data)
-    if request.method == 'POST':
-        if write_json_file(config['path'], request.json):
-            return jsonify({"status": "success"})
-        return jsonify({"status": "error", "message": "Failed to save favorites"}), 500
+def make_data_file_handler(key):
+    """Builds the GET/POST view that reads and writes the data file configured under `key`."""
+    config = DATA_FILES[key]
+
+    def handler():
+        if request.method == 'GET':
+            data = read_json_file(config['path'], config['default'])
+            return jsonify(data)
+        if request.method == 'POST':
+            if write_json_file(config['path'], request.json):
+                return jsonify({"status": "success"})
+            return jsonify({"status": "error", "message": f"Failed to save {config['label']}"}), 500
 
-@app.route('/api/tags', methods=['GET', 'POST'])
-def handle_tags():
-    """Handles reading and writing the chat-to-tag assignments."""
-    config = DATA_FILES['tags']
-    if request.method == 'GET':
-        data = read_json_file(config['path'], config['default'])
-        return jsonify(data)
-    if request.method == 'POST':
-        if write_json_file(config['path'], request.json):
-            return jsonify({"status": "success"})
-        return jsonify({"status": "error", "message": "Failed to save tags"}), 500
+    handler.__name__ = f'handle_{key}'
+    handler.__doc__ = f"Handles reading and writing the {config['label']} data."
+    return handler
 
-@app.route('/api/all-tags', methods=['GET', 'POST'])
-def handle_all_tags():
-    """Handles reading and writing the global list of all available tags."""
-    config = DATA_FILES['all_tags']
-    if request.method == 'GET':
-        data = read_json_file(config['path'], config['default'])
-        return jsonify(data)
-    if request.method == 'POST':
-        if write_json_file(config['path'], request.json):
-            return jsonify({"status": "success"})
-        return jsonify({"status": "error", "message": "Failed to save all tags"}), 500
+# Registers /api/favorites, /api/tags and /api/all-tags.
+for key in DATA_FILES:
+    app.add_url_rule(f"/api/{key.replace('_', '-')}", view_func=make_data_file_handler(key), methods=['GET', 'POST'])
 
 @app.route('/api/refresh-data', methods=['POST'])
 def handle_refresh():
@@ -109,4 +145,4 @@ def handle_refresh():
 
 if __name__ == '__main__':
     print("Server is running! Open http://127.0.0.1:5000 in your browser.")
-    app.run(host='0.0.0.0', port=5000, debug=True)
\ No newline at end of file
+    serve(app, host='0.0.0.0', port=5000, threads=SERVER_THREADS)
\ No newline at end of file